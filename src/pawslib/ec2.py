@@ -1,7 +1,68 @@
-from math import log
+import hashlib
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import ip_network
 
 import boto3
+from botocore.config import Config
+
+# Number of instances requested in a single create_instances() call by
+# batch_launch_ami_like_instances()
+MAX_INSTANCES_PER_CALL = 1000
+# Number of instance IDs passed to a single describe_instances() call
+MAX_DESCRIBE_INSTANCE_IDS = 1000
+# Maximum length of a ClientToken accepted by EC2
+MAX_CLIENT_TOKEN_LENGTH = 64
+# Total number of times botocore tries every API call, the first attempt
+# included, when AWS throttles it or it fails with a transient error. This is
+# the only retry layer, create_instances() is not retried on top of it.
+API_MAX_ATTEMPTS = 9
+# Seconds a region's list of availability zones is cached for. Zones are
+# rarely added or removed, so there's no point in asking AWS every time.
+AZ_CACHE_TTL = 3600
+# Number of regions split_nets_across_regions() queries at the same time,
+# keeps it under the EC2 Describe* request limits
+MAX_CONCURRENT_REGIONS = 10
+
+# Used for all clients and resources created by this module. Adaptive
+# retries back off when AWS throttles requests and the larger connection
+# pool lets concurrent calls share a client.
+_B3_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": API_MAX_ATTEMPTS},
+    max_pool_connections=50,
+)
+
+# b3_session -> {region: (time fetched, list of zone names)}. Weak keys, so
+# the cache doesn't keep sessions alive after the caller is done with them.
+_az_cache = weakref.WeakKeyDictionary()
+# b3_session -> {region: EC2 client}, see _ec2_client()
+_ec2_clients = weakref.WeakKeyDictionary()
+# Per thread cache of EC2 resources, see _ec2_resource()
+_thread_local = threading.local()
+
+
+class BatchLaunchError(Exception):
+    """
+    Raised by batch_launch_ami_like_instances() when a create_instances()
+    call fails after earlier calls already launched instances.
+
+    Attributes:
+        error: the exception raised by the failed call
+        launched: list of the instances launched before the failure. They
+            are not terminated and are left for the caller to deal with.
+    """
+
+    def __init__(self, error, launched):
+        super().__init__(
+            "{} instance(s) launched before the batch failed: {}".format(
+                len(launched), error
+            )
+        )
+        self.error = error
+        self.launched = launched
 
 
 def launch_ami_like_instance(
@@ -14,7 +75,9 @@ def launch_ami_like_instance(
     Args:
         ami_id: ID of AMI to use for the new instance
         model_id: launch new instances in this one's likeness
-        count: number of instances to start
+        count: number of instances to start. All of them are launched with
+            a single create_instances() call; to launch instances like
+            several models at once use batch_launch_ami_like_instances()
         copy_tags: dictionary, optional.
             {
                 'CopyTags': True|False,
@@ -29,14 +92,18 @@ def launch_ami_like_instance(
             also be set on the new ones. Tags present in SetTags will
             also be set. Tags from SetTags will overwrite the ones
             coppied from the model instance if they have the same key.
-            If the parameter receives any other values in the
-            dictionary, it will ignore them.
+            Both keys are optional, CopyTags defaults to False. If the
+            parameter receives any other values in the dictionary, it
+            will ignore them.
         b3_session: Boto3 Session object. If passed to the function, boto3
             clients and resources will be based off it, otherwise the
             default session will be used.
         kwargs: any additional parameters will be passed to the boto3
             function ec2.create_instances() directly. Primary use would
             probably be to specify ClientToken or PrivateIpAddress.
+            If ClientToken is not specified botocore generates one and
+            reuses it when it retries a throttled call, so retries don't
+            launch the instances twice.
             See https://boto3.readthedocs.io/en/latest/reference/services/
                 ec2.html#EC2.ServiceResource.create_instances
             and https://docs.aws.amazon.com/AWSEC2/latest/APIReference/
@@ -56,26 +123,214 @@ def launch_ami_like_instance(
     Returns:
         list of instance IDs that are being created
     """
+    ec2 = _ec2_resource(b3_session)
+    ec2_model = _describe_instances(ec2.meta.client, [model_id])[model_id]
+    params = _ami_like_instance_params(ec2_model, ami_id, copy_tags, **kwargs)
+    new_instances = ec2.create_instances(
+        MaxCount=count, MinCount=count, **params
+    )
+    return new_instances
+
+
+def batch_launch_ami_like_instances(specs, b3_session=None):
+    """
+    Launch instances for several launch_ami_like_instance() requests at
+    once. Requests that end up with identical launch parameters (same AMI,
+    instance type, subnet, security groups, tags, etc.) are merged into a
+    single ec2.create_instances() call, so launching N instances in the
+    likeness of one model takes one API call instead of N.
+
+    Args:
+        specs: list of dictionaries, each one holding the arguments of a
+            launch_ami_like_instance() call.
+            [
+                {
+                    'ami_id': 'string',
+                    'model_id': 'string',
+                    'count': 123,
+                    'copy_tags': {...},
+                    'kwargs': {...}
+                }
+            ]
+            'count', 'copy_tags' and 'kwargs' are optional and have the
+            same meaning and defaults as in launch_ami_like_instance().
+            Requests are only merged if their kwargs are identical.
+            If a group needs several create_instances() calls and its
+            kwargs include a ClientToken, calls after the first one use
+            the token with "-1", "-2", etc. appended, or a hash of that
+            if it would be longer than MAX_CLIENT_TOKEN_LENGTH.
+        b3_session: Boto3 Session object. If passed to the function, boto3
+            clients and resources will be based off it, otherwise the
+            default session will be used.
+
+    Returns:
+        list with one element per spec, in the same order, each element
+        being the list of instances created for that spec
+
+    Raises:
+        BatchLaunchError: if a create_instances() call fails after other
+            calls, for other groups or for earlier chunks of a group larger
+            than MAX_INSTANCES_PER_CALL, already launched instances. Those
+            can't be rolled back and are available in its 'launched'
+            attribute. If nothing was launched yet, the original exception
+            is raised instead.
+    """
+    ec2 = _ec2_resource(b3_session)
+    # Look up all model instances at once
+    models = _describe_instances(
+        ec2.meta.client, [spec["model_id"] for spec in specs]
+    )
+    # Group specs by the parameters they would be launched with
+    groups = dict()
+    for index, spec in enumerate(specs):
+        params = _ami_like_instance_params(
+            models[spec["model_id"]],
+            spec["ami_id"],
+            spec.get("copy_tags", {}),
+            **spec.get("kwargs", {})
+        )
+        key = json.dumps(params, sort_keys=True, default=str)
+        if key not in groups:
+            groups[key] = {"params": params, "members": []}
+        groups[key]["members"].append((index, spec.get("count", 1)))
+    launched = [None] * len(specs)
+    # Every instance launched so far, in case a later call fails
+    launched_so_far = list()
+    for group in groups.values():
+        total = sum(count for _, count in group["members"])
+        params = dict(group["params"])
+        client_token = params.get("ClientToken")
+        new_instances = list()
+        call = 0
+        while len(new_instances) < total:
+            chunk = min(total - len(new_instances), MAX_INSTANCES_PER_CALL)
+            # Every call needs its own token, or AWS would return the
+            # instances of the first one. Without one botocore generates it.
+            if client_token and call:
+                params["ClientToken"] = _chunk_client_token(client_token, call)
+            try:
+                new_instances += ec2.create_instances(
+                    MaxCount=chunk, MinCount=chunk, **params
+                )
+            except Exception as e:
+                if not launched_so_far and not new_instances:
+                    raise
+                raise BatchLaunchError(
+                    e, launched_so_far + new_instances
+                ) from e
+            call += 1
+        launched_so_far += new_instances
+        # Hand the new instances back to the specs that asked for them
+        start = 0
+        for index, count in group["members"]:
+            launched[index] = new_instances[start : start + count]
+            start += count
+    return launched
+
+
+def _chunk_client_token(client_token, call):
+    """
+    Derive the ClientToken of call number 'call' of a batch group from the
+    caller's token, keeping it within MAX_CLIENT_TOKEN_LENGTH characters.
+    """
+    token = "{}-{}".format(client_token, call)
+    if len(token) > MAX_CLIENT_TOKEN_LENGTH:
+        token = hashlib.sha256(token.encode()).hexdigest()
+    return token
+
+
+def _session(b3_session=None):
+    """
+    Return b3_session, or boto3's current default session if it's None.
+    The caches in this module are keyed on the returned session, so a
+    default session set up later with boto3.setup_default_session() is
+    picked up instead of the one in use at the first call.
+    """
     if b3_session:
-        ec2 = b3_session.resource("ec2")
-    else:
-        ec2 = boto3.resource("ec2")
-    ec2_model = ec2.Instance(model_id)
+        return b3_session
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    return boto3.DEFAULT_SESSION
+
+
+def _ec2_client(b3_session=None, region=None):
+    """
+    Return an EC2 client for the session and region, reusing the one
+    created by a previous call with the same arguments. Clients are thread
+    safe, so they're shared by all threads. They're kept only as long as
+    the session itself is alive.
+    """
+    b3_session = _session(b3_session)
+    clients = _ec2_clients.setdefault(b3_session, dict())
+    if region not in clients:
+        clients[region] = b3_session.client(
+            "ec2", region_name=region, config=_B3_CONFIG
+        )
+    return clients[region]
+
+
+def _ec2_resource(b3_session=None):
+    """
+    Return an EC2 resource for the session, reusing the one created by a
+    previous call with the same session from the same thread. Resources
+    aren't thread safe, so every thread gets its own. They're kept only as
+    long as the session itself is alive.
+    """
+    b3_session = _session(b3_session)
+    try:
+        resources = _thread_local.ec2_resources
+    except AttributeError:
+        resources = _thread_local.ec2_resources = weakref.WeakKeyDictionary()
+    if b3_session not in resources:
+        resources[b3_session] = b3_session.resource("ec2", config=_B3_CONFIG)
+    return resources[b3_session]
+
+
+def _describe_instances(ec2_client, instance_ids):
+    """
+    Describe instances using as few API calls as possible.
+
+    Args:
+        ec2_client: boto3 EC2 client
+        instance_ids: list of instance IDs, may contain duplicates
+
+    Returns:
+        dictionary mapping each instance ID to its description, as
+        returned by ec2_client.describe_instances()
+    """
+    instance_ids = list(dict.fromkeys(instance_ids))
+    instances = dict()
+    for start in range(0, len(instance_ids), MAX_DESCRIBE_INSTANCE_IDS):
+        response = ec2_client.describe_instances(
+            InstanceIds=instance_ids[start : start + MAX_DESCRIBE_INSTANCE_IDS]
+        )
+        for reservation in response["Reservations"]:
+            for instance in reservation["Instances"]:
+                instances[instance["InstanceId"]] = instance
+    return instances
+
+
+def _ami_like_instance_params(ec2_model, ami_id, copy_tags, **kwargs):
+    """
+    Build the ec2.create_instances() parameters, except MinCount and
+    MaxCount, for launching an instance from ami_id in the likeness of
+    ec2_model, an instance description as returned by describe_instances().
+    See launch_ami_like_instance() for the other arguments.
+    """
     # Copy tags
-    if "SetTags" in copy_tags:
-        tags_to_set = copy_tags["SetTags"]
-        tag_keys_to_set = [tag["Key"] for tag in copy_tags["SetTags"]]
+    tags_to_set = copy_tags.get("SetTags") or []
+    if copy_tags.get("CopyTags", False):
+        tag_keys_to_set = {tag["Key"] for tag in tags_to_set}
         tags_to_copy = [
-            tag for tag in ec2_model.tags if tag["Key"] not in tag_keys_to_set
+            tag
+            for tag in ec2_model.get("Tags", [])
+            if tag["Key"] not in tag_keys_to_set
         ]
     else:
-        tags_to_set = []
-        tags_to_copy = ec2_model.tags
-    if copy_tags["CopyTags"]:
-        tag_spec = [{"Tags": tags_to_copy + tags_to_set}]
-    else:
-        tag_spec = [{"Tags": tags_to_set}]
-    tag_spec[0]["ResourceType"] = "instance"
+        tags_to_copy = []
+    tag_spec = [
+        {"ResourceType": "instance", "Tags": tags_to_copy + tags_to_set}
+    ]
     # Not coppied, can be passed on through kwargs
     #   DisableApiTermination
     #   InstanceInitiatedShutdownBehavior
@@ -84,25 +339,24 @@ def launch_ami_like_instance(
     #   CreditSpecification
     #   CpuOptions
     instance_role = {}
-    if ec2_model.iam_instance_profile is not None:
-        instance_role["Arn"] = ec2_model.iam_instance_profile["Arn"]
-        # instance_role['Name'] = ec2_model.iam_instance_profile['Arn'][
-        #         ec2_model.iam_instance_profile['Arn'].rfind('/') + 1:]
-    new_instances = ec2.create_instances(
+    if "IamInstanceProfile" in ec2_model:
+        instance_role["Arn"] = ec2_model["IamInstanceProfile"]["Arn"]
+        # instance_role['Name'] = ec2_model['IamInstanceProfile']['Arn'][
+        #         ec2_model['IamInstanceProfile']['Arn'].rfind('/') + 1:]
+    return dict(
         ImageId=ami_id,
-        InstanceType=ec2_model.instance_type,
-        KeyName=ec2_model.key_pair.key_name,
-        MaxCount=count,
-        MinCount=count,
-        Monitoring={"Enabled": ec2_model.monitoring["State"] == "enabled"},
-        SecurityGroupIds=[gid["GroupId"] for gid in ec2_model.security_groups],
-        SubnetId=ec2_model.subnet_id,
-        EbsOptimized=ec2_model.ebs_optimized,
+        InstanceType=ec2_model["InstanceType"],
+        KeyName=ec2_model["KeyName"],
+        Monitoring={"Enabled": ec2_model["Monitoring"]["State"] == "enabled"},
+        SecurityGroupIds=sorted(
+            gid["GroupId"] for gid in ec2_model["SecurityGroups"]
+        ),
+        SubnetId=ec2_model["SubnetId"],
+        EbsOptimized=ec2_model["EbsOptimized"],
         IamInstanceProfile=instance_role,
         TagSpecifications=tag_spec,
         **kwargs
     )
-    return new_instances
 
 
 def split_net_across_zones(net, region, subnets=4, b3_session=None):
@@ -129,21 +383,118 @@ def split_net_across_zones(net, region, subnets=4, b3_session=None):
               'az': eu-west-1b'}]
         It will try to cover all zones and cycle back to the first one if
         more subnets are specified than available zones
+
+    Availability zones are cached per region and session for AZ_CACHE_TTL
+    seconds, so repeated calls for the same region don't query AWS again.
     """
     # Check that subnets is a power of 2
-    if not (not subnets & (subnets - 1) and subnets and type(subnets) is int):
+    if not (
+        isinstance(subnets, int)
+        and not isinstance(subnets, bool)
+        and subnets > 0
+        and not subnets & (subnets - 1)
+    ):
         raise ValueError("Number of subnets must be a power of 2")
-    if b3_session:
-        ec2 = b3_session.client("ec2", region_name=region)
-    else:
-        ec2 = boto3.client("ec2", region_name=region)
-    azs = list()
-    for az in ec2.describe_availability_zones()["AvailabilityZones"]:
-        azs.append(az["ZoneName"])
-    snets = list(ip_network(net).subnets(prefixlen_diff=int(log(subnets, 2))))
-    net_split = list()
-    for index, subnet in enumerate(snets):
-        az = azs[index % len(azs)]
-        net_split.append({"cidr": subnet.with_prefixlen, "az": az})
+    azs = _availability_zones(region, b3_session)
+    n_azs = len(azs)
+    net_split = [None] * subnets
+    for index, subnet in enumerate(
+        ip_network(net).subnets(prefixlen_diff=(subnets - 1).bit_length())
+    ):
+        net_split[index] = {
+            "cidr": subnet.with_prefixlen,
+            "az": azs[index % n_azs],
+        }
 
     return net_split
+
+
+def split_nets_across_regions(nets, subnets=4, b3_session=None):
+    """
+    Split several networks into subnets across the availability zones of
+    their regions. Same as calling split_net_across_zones() for each of
+    them, but regions that aren't already cached are queried concurrently.
+
+    Args:
+        nets: list of (net, region) tuples. See split_net_across_zones()
+            for their format.
+        subnets: Number of subnets each network should be split into. Must
+            be a power of 2.
+        b3_session: Boto3 Session object. If passed to the function, boto3
+            clients and resources will be based off it, otherwise the
+            default session will be used.
+
+    Returns:
+        A list with one element per network, in the same order, each of
+        them being the list returned by split_net_across_zones()
+    """
+    b3_session = _session(b3_session)
+    regions = [
+        region
+        for region in dict.fromkeys(region for _, region in nets)
+        if _cached_availability_zones(region, b3_session) is None
+    ]
+    # Sessions aren't thread safe, so clients are created here and only
+    # the API calls are made from the worker threads
+    clients = [_ec2_client(b3_session, region) for region in regions]
+    if clients:
+        with ThreadPoolExecutor(
+            max_workers=min(len(clients), MAX_CONCURRENT_REGIONS)
+        ) as executor:
+            zones = executor.map(_zone_names, clients)
+            for region, azs in zip(regions, zones):
+                _cache_availability_zones(region, b3_session, azs)
+    return [
+        split_net_across_zones(net, region, subnets, b3_session)
+        for net, region in nets
+    ]
+
+
+def _availability_zones(region, b3_session=None):
+    """
+    Return the names of the availability zones in a region, from cache if
+    they were fetched less than AZ_CACHE_TTL seconds ago.
+    """
+    b3_session = _session(b3_session)
+    azs = _cached_availability_zones(region, b3_session)
+    if azs is None:
+        azs = _zone_names(_ec2_client(b3_session, region))
+        _cache_availability_zones(region, b3_session, azs)
+    return azs
+
+
+def _cached_availability_zones(region, b3_session=None):
+    """
+    Return the cached availability zone names for a region, or None if
+    they're not cached or the cache entry expired.
+    """
+    regions = _az_cache.get(_session(b3_session), {})
+    cached = regions.get(region)
+    if cached is None:
+        return None
+    if time.monotonic() - cached[0] > AZ_CACHE_TTL:
+        del regions[region]
+        return None
+    return cached[1]
+
+
+def _cache_availability_zones(region, b3_session, azs):
+    """
+    Cache the availability zone names for a region, dropping the session's
+    expired entries while at it.
+    """
+    now = time.monotonic()
+    b3_session = _session(b3_session)
+    regions = {
+        cached_region: cached
+        for cached_region, cached in _az_cache.get(b3_session, {}).items()
+        if now - cached[0] <= AZ_CACHE_TTL
+    }
+    regions[region] = (now, azs)
+    _az_cache[b3_session] = regions
+
+
+def _zone_names(ec2_client):
+    """Query AWS for the names of the availability zones in a region"""
+    response = ec2_client.describe_availability_zones()
+    return [az["ZoneName"] for az in response["AvailabilityZones"]]
@@ -1,5 +1,15 @@
 import re
 
+# Non-alphanumeric characters at the start or end of a string
+_LEAD_TRAIL = re.compile(r"^[\W_]+|[\W_]+$")
+# A run of non-alphanumeric characters and the character following it
+_SEP = re.compile(r"[\W_]+(.)", re.DOTALL)
+# Maps every non-alphanumeric ASCII character to NUL, so ASCII strings can
+# be split on separators without going through the regex engine
+_ASCII_SEP_TABLE = str.maketrans(
+    {code: "\x00" for code in range(128) if not chr(code).isalnum()}
+)
+
 
 def alphanum(string):
     """Remove non-alphanumeric characters
@@ -17,14 +27,14 @@ def alphanum(string):
     Returns:
         string
     """
-    m = re.search(r"[\W_]", string)
-    while m is not None:
-        if m.start() == 0:
-            string = string[1:]
-        elif m.start() == len(string) - 1:
-            string = string[:-1]
-        else:
-            string = string[: m.start()] + string[m.end() : m.end()+1].upper() + string[m.end()+1:]
-        m = re.search(r"[\W_]", string)
-
-    return string
+    if string.isascii():
+        parts = string.translate(_ASCII_SEP_TABLE).split("\x00")
+        parts = [part for part in parts if part]
+        if not parts:
+            return ""
+        return parts[0] + "".join(
+            part[0].upper() + part[1:] for part in parts[1:]
+        )
+    # Non-ASCII letters and digits also count as alphanumeric
+    string = _LEAD_TRAIL.sub("", string)
+    return _SEP.sub(lambda m: m.group(1).upper(), string)